@@ -1,256 +1,787 @@
 import argparse
+import atexit
+import functools
+import itertools
 import json
 import logging
 import logging.handlers
+import os
+import queue
+import random
 import sys
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser, SectionProxy
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable
 
 import requests
-import urllib3
 from jellyfin_apiclient_python import JellyfinClient, api
+from jellyfin_apiclient_python.connection_manager import CONNECTION_STATE
 from jellyfin_apiclient_python.exceptions import HTTPException
+from jellyfin_apiclient_python.ws_client import WSClient
 from pypresence import DiscordNotFound, PipeClosed, Presence
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
-from urllib3.exceptions import InsecureRequestWarning
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+
+    def json_loads(data: bytes) -> Any:
+        return orjson.loads(data)
+
+    def json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+except ImportError:
+
+    def json_loads(data: bytes) -> Any:
+        return json.loads(data)
+
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
 
 CLIENT_ID = '1238889120672120853'
 DEFAULT_POSTER_URL = 'jellyfin_icon'
 
 logger = logging.getLogger(__name__)
-urllib3.disable_warnings(InsecureRequestWarning)
+
+POSTER_CACHE_TTL = 7 * 24 * 60 * 60
+WEBSOCKET_RETRY_INTERVAL = 60
+MAX_IDLE_INTERVAL = 60
+MAX_FAILED_POLLS = 3
+MAX_START_DRIFT = 5
+RETRY_BASE_DELAY = 0.5
+MAX_RETRY_DELAY = 60
+
+cache: dict[str, dict] = {'tmdb_ids': {}, 'posters': {}, 'etags': {}}
+cache_path: str | None = None
+config_cache: dict[str, tuple[int | None, SectionProxy]] = {}
+series_tmdb_ids: dict[tuple[str, str], int] = {}
+album_musicbrainz_ids: dict[tuple[str, str], tuple[str, str | None]] = {}
+log_listener: logging.handlers.QueueListener | None = None
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    no_retry = threading.local()
+
+    def __init__(self, *args, timeout: float | tuple[float, float] = (3.05, 10), **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    @property
+    def max_retries(self) -> Retry:
+        if getattr(self.no_retry, 'active', False):
+            return Retry(0, read=False)
+        return self._max_retries
+
+    @max_retries.setter
+    def max_retries(self, max_retries: Retry):
+        self._max_retries = max_retries
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+SESSION = requests.Session()
+SESSION.headers.update({'Accept': 'application/json'})
+HTTP_ADAPTER = TimeoutHTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+SESSION.mount('http://', HTTP_ADAPTER)
+SESSION.mount('https://', HTTP_ADAPTER)
+for metadata_host in ('https://api.themoviedb.org', 'https://coverartarchive.org'):
+    SESSION.mount(
+        metadata_host,
+        TimeoutHTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=2,
+            max_retries=Retry(total=2, backoff_factor=0.3),
+        ),
+    )
+POOL = ThreadPoolExecutor(max_workers=4)
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    jellyfin_host: str
+    api_token: str
+    username: str
+    tmdb_api_key: str
+    media_types: frozenset[str]
+    device_id: str
 
 
 def get_config(ini_path: str) -> SectionProxy:
-    config = ConfigParser()
+    try:
+        mtime = os.stat(ini_path).st_mtime_ns
+    except OSError:
+        mtime = None
+    cached = config_cache.get(ini_path)
+    if cached is None or cached[0] != mtime:
+        cached = config_cache[ini_path] = (mtime, read_config(ini_path))
+    return cached[1]
+
+
+def read_config(ini_path: str) -> SectionProxy:
+    config = ConfigParser(interpolation=None)
     config.read(ini_path)
     return config['DEFAULT']
 
 
-def get_user_id(config: SectionProxy) -> str:
-    url = config['JELLYFIN_HOST'] + '/Users'
-    headers = {'Accept': 'application/json', 'X-Emby-Token': config['API_TOKEN']}
-    user_data = requests.request('GET', url, headers=headers, verify=False)
-    for user in user_data.json():
-        if config['USERNAME'] in user['Name']:
+def set_config(config: SectionProxy, ini_path: str):
+    with open(ini_path + '.tmp', 'w') as ini_file:
+        config.parser.write(ini_file)
+    os.replace(ini_path + '.tmp', ini_path)
+    config_cache[ini_path] = (os.stat(ini_path).st_mtime_ns, config)
+
+
+def set_device_id(config: SectionProxy, ini_path: str):
+    try:
+        uuid.UUID(config.get('DEVICE_ID', ''))
+    except ValueError:
+        config['DEVICE_ID'] = str(uuid.uuid4())
+        set_config(config, ini_path)
+
+
+def get_settings(config: SectionProxy) -> Settings:
+    return Settings(
+        jellyfin_host=config['JELLYFIN_HOST'],
+        api_token=config['API_TOKEN'],
+        username=config['USERNAME'],
+        tmdb_api_key=config.get('TMDB_API_KEY', ''),
+        media_types=frozenset(
+            media_type.strip() for media_type in config.get('MEDIA_TYPES', '').split(',')
+        ),
+        device_id=config['DEVICE_ID'],
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def get_user_id(jellyfin_host: str, api_token: str, username: str) -> str:
+    url = jellyfin_host + '/Users'
+    user_data = SESSION.get(
+        url, params={'isDisabled': 'false'}, headers={'X-Emby-Token': api_token}
+    )
+    user_data.raise_for_status()
+    folded_name = username.casefold()
+    for user in json_loads(user_data.content):
+        if user['Name'].casefold() == folded_name:
             return user['Id']
-    raise ValueError(f'{config["USERNAME"]} Not Found.')
+    raise ValueError(f'{username} Not Found.')
+
+
+class SessionListener:
 
+    def __init__(self):
+        self.client: JellyfinClient | None = None
+        self.sessions: list[dict] | None = None
+        self.updated = threading.Event()
+        self.closed = threading.Event()
+        self.last_attempt = 0.0
 
-def get_jellyfin_api(config: SectionProxy, refresh_rate: int) -> api.API:
-    while True:
+    def attach(self, client: JellyfinClient):
+        if self.client is not None:
+            self.client.wsc.stop_client()
+        self.client = client
+        self.sessions = None
+        client.callback = functools.partial(self.on_message, client)
+        self.start(client)
+
+    def start(self, client: JellyfinClient):
+        if self.closed.is_set():
+            return
+        self.last_attempt = time.monotonic()
+        client.wsc.daemon = True
+        client.start_wsc()
+
+    def reconnect(self):
+        if self.client is None or self.client.wsc.is_alive():
+            return
+        if time.monotonic() - self.last_attempt < WEBSOCKET_RETRY_INTERVAL:
+            return
+        self.client.wsc = WSClient(self.client)
+        self.start(self.client)
+
+    def close(self):
+        self.closed.set()
+        self.updated.set()
+        if self.client is not None:
+            self.client.wsc.stop_client()
+
+    def on_message(self, client: JellyfinClient, message_type: str, data: dict):
+        if self.client is None or client is not self.client:
+            return
+        match message_type:
+            case 'WebSocketConnect':
+                client.wsc.send('SessionsStart', '0,1500')
+                logger.debug('Connection Established: WebSocket.')
+            case 'Sessions':
+                self.sessions = data['value']
+                self.updated.set()
+            case 'WebSocketDisconnect':
+                self.sessions = None
+                self.updated.set()
+                logger.warning('Connection Lost: WebSocket. Polling...')
+
+    def wait(self, deadline: float):
+        if self.sessions is not None:
+            self.updated.wait()
+        else:
+            self.updated.wait(max(deadline - time.monotonic(), 0))
+        self.updated.clear()
+
+
+def get_retry_delay(attempt: int) -> float:
+    delay = min(RETRY_BASE_DELAY * 2 ** min(attempt, 8), MAX_RETRY_DELAY)
+    return delay + random.uniform(0, delay / 4)
+
+
+def get_jellyfin_api(settings: Settings, listener: SessionListener) -> api.API | None:
+    for attempt in itertools.count():
         try:
             client = JellyfinClient()
-            client.config.app('jellyfin-rpc', '0.1.0', 'Discord RPC', uuid.uuid4())
+            client.config.app('jellyfin-rpc', '0.1.0', 'Discord RPC', settings.device_id)
             client.config.data['auth.ssl'] = True
-            client.authenticate(
+            state = client.authenticate(
                 {
                     'Servers': [
                         {
-                            'address': config['JELLYFIN_HOST'],
-                            'AccessToken': config['API_TOKEN'],
-                            'UserId': get_user_id(config),
+                            'address': settings.jellyfin_host,
+                            'AccessToken': settings.api_token,
+                            'UserId': get_user_id(
+                                settings.jellyfin_host, settings.api_token, settings.username
+                            ),
                             'DateLastAccessed': 0,
                         }
                     ]
                 },
                 discover=False,
             )
+            if state['State'] != CONNECTION_STATE['SignedIn']:
+                raise RequestException('Sign-In Failed')
+            client.http.session = SESSION
+            client.http.keep_alive = True
             logger.debug('Connection Established: Jellyfin.')
-        except (RequestException, json.JSONDecodeError):
-            logger.error('Connection Failed: Jellyfin. Retrying...')
-            time.sleep(refresh_rate)
+            listener.attach(client)
+        except (RequestException, ValueError) as error:
+            get_user_id.cache_clear()
+            if attempt % 10 == 0:
+                logger.error('Connection Failed: Jellyfin (%s). Retrying...', error)
+            if listener.closed.wait(get_retry_delay(attempt)):
+                return None
             continue
         return client.jellyfin
+    raise AssertionError('unreachable')
 
 
-def get_series_poster(api_key: str, imdb_id: str, season: int) -> str:
-    response = requests.get(
-        f"https://api.themoviedb.org/3/find/{imdb_id}?api_key={api_key}&external_source=imdb_id"
-    )
-    tmdb_id = json.loads(response.text)['tv_episode_results'][0]['show_id']
-    response = requests.get(
-        f"https://api.themoviedb.org/3/tv/{tmdb_id}/season/{season}/images?api_key={api_key}"
+def load_cache(json_path: str):
+    global cache_path
+    cache_path = json_path
+    try:
+        with open(json_path, 'rb') as json_file:
+            cached = json_loads(json_file.read())
+        cache['tmdb_ids'].update(cached['tmdb_ids'])
+        cache['etags'].update(cached.get('etags', {}))
+        cache['posters'].update(
+            (key, entry) for key, entry in cached['posters'].items() if entry[1] > time.time()
+        )
+    except FileNotFoundError:
+        pass
+    except (OSError, KeyError, json.JSONDecodeError):
+        logger.warning('Invalid Cache File. Ignoring...')
+
+
+def save_cache():
+    if cache_path is None:
+        return
+    try:
+        with open(cache_path + '.tmp', 'wb') as json_file:
+            json_file.write(json_dumps(cache))
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError:
+        logger.warning('Cache Write Failed. Ignoring...')
+        try:
+            os.remove(cache_path + '.tmp')
+        except OSError:
+            pass
+
+
+def get_cached_poster(key: str) -> str | None:
+    entry = cache['posters'].get(key)
+    if entry is None or entry[1] <= time.time():
+        return None
+    return entry[0]
+
+
+def set_cached_poster(key: str, poster_url: str) -> str:
+    cache['posters'][key] = (poster_url, time.time() + POSTER_CACHE_TTL)
+    save_cache()
+    return poster_url
+
+
+def fetch_poster(url: str, extract: Callable[[dict], str], **kwargs) -> str | None:
+    validator = cache['etags'].get(url)
+    headers = {'If-None-Match': validator[0]} if validator else {}
+    response = SESSION.get(url, headers=headers, **kwargs)
+    if response.status_code == 304 and validator:
+        return validator[1]
+    response.raise_for_status()
+    try:
+        poster_url = extract(json_loads(response.content))
+    except (KeyError, IndexError, ValueError):
+        return None
+    if etag := response.headers.get('ETag'):
+        cache['etags'][url] = (etag, poster_url)
+    return poster_url
+
+
+def extract_tmdb_poster(data: dict) -> str:
+    return 'https://image.tmdb.org/t/p/w185' + data['posters'][0]['file_path']
+
+
+def extract_album_cover(data: dict) -> str:
+    return data['images'][0]['image']
+
+
+def get_tmdb_id(api_key: str, imdb_id: str, media_type: str) -> int:
+    if imdb_id in cache['tmdb_ids']:
+        return cache['tmdb_ids'][imdb_id]
+    response = SESSION.get(
+        f'https://api.themoviedb.org/3/find/{imdb_id}',
+        params={'api_key': api_key, 'external_source': 'imdb_id'},
     )
+    response.raise_for_status()
+    if media_type == 'Episode':
+        tmdb_id = json_loads(response.content)['tv_episode_results'][0]['show_id']
+    else:
+        tmdb_id = json_loads(response.content)['movie_results'][0]['id']
+    cache['tmdb_ids'][imdb_id] = tmdb_id
+    save_cache()
+    return tmdb_id
+
+
+def get_series_tmdb_id(jellyfin_host: str, jellyfin_api: api.API, series_id: str) -> int | None:
+    key = (jellyfin_host, series_id)
+    if key in series_tmdb_ids:
+        return series_tmdb_ids[key]
     try:
-        return (
-            'https://image.tmdb.org/t/p/w185/'
-            + json.loads(response.text)['posters'][0]['file_path']
+        tmdb_id = int(jellyfin_api.get_item(series_id)['ProviderIds']['Tmdb'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    series_tmdb_ids[key] = tmdb_id
+    return tmdb_id
+
+
+def get_album_musicbrainz_ids(
+    jellyfin_host: str, jellyfin_api: api.API, album_id: str | None
+) -> tuple[str, str | None] | None:
+    if album_id is None:
+        return None
+    key = (jellyfin_host, album_id)
+    if key in album_musicbrainz_ids:
+        return album_musicbrainz_ids[key]
+    try:
+        provider_ids = jellyfin_api.get_item(album_id)['ProviderIds']
+        musicbrainz_ids = (
+            provider_ids['MusicBrainzAlbum'],
+            provider_ids.get('MusicBrainzReleaseGroup'),
         )
-    except KeyError:
-        logger.warning('No Poster Available on TMDB. Skipping...')
+    except (KeyError, TypeError):
+        return None
+    album_musicbrainz_ids[key] = musicbrainz_ids
+    return musicbrainz_ids
+
+
+@functools.lru_cache(maxsize=256)
+def get_series_poster(api_key: str, imdb_id: str, season: int) -> str:
+    try:
+        tmdb_id = get_tmdb_id(api_key, imdb_id, 'Episode')
+    except (KeyError, IndexError, ValueError):
+        logger.warning('No TMDB ID Found. Skipping...')
         return DEFAULT_POSTER_URL
+    return _get_season_poster(api_key, tmdb_id, season)
 
 
-def get_movie_poster(api_key: str, imdb_id: str) -> str:
-    response = requests.get(
-        f"https://api.themoviedb.org/3/find/{imdb_id}?api_key={api_key}&external_source=imdb_id"
+@functools.lru_cache(maxsize=256)
+def _get_season_poster(api_key: str, tmdb_id: int, season: int) -> str:
+    cache_key = f'series:{tmdb_id}:{season}'
+    if poster_url := get_cached_poster(cache_key):
+        return poster_url
+    params = {'api_key': api_key, 'include_image_language': 'en,null'}
+    season_future = POOL.submit(
+        fetch_poster,
+        f'https://api.themoviedb.org/3/tv/{tmdb_id}/season/{season}/images',
+        extract_tmdb_poster,
+        params=params,
     )
-    tmdb_id = json.loads(response.text)['movie_results'][0]['id']
-    response = requests.get(
-        f"https://api.themoviedb.org/3/movie/{tmdb_id}/images?api_key={api_key}"
+    series_future = POOL.submit(
+        fetch_poster,
+        f'https://api.themoviedb.org/3/tv/{tmdb_id}/images',
+        extract_tmdb_poster,
+        params=params,
     )
+    for future in (season_future, series_future):
+        if poster_url := future.result():
+            series_future.cancel()
+            return set_cached_poster(cache_key, poster_url)
+    logger.warning('No Poster Available on TMDB. Skipping...')
+    return DEFAULT_POSTER_URL
+
+
+@functools.lru_cache(maxsize=256)
+def get_movie_poster(api_key: str, imdb_id: str) -> str:
     try:
-        return (
-            'https://image.tmdb.org/t/p/w185/'
-            + json.loads(response.text)['posters'][0]['file_path']
+        tmdb_id = get_tmdb_id(api_key, imdb_id, 'Movie')
+    except (KeyError, IndexError, ValueError):
+        logger.warning('No TMDB ID Found. Skipping...')
+        return DEFAULT_POSTER_URL
+    return _get_movie_poster(api_key, tmdb_id)
+
+
+@functools.lru_cache(maxsize=256)
+def _get_movie_poster(api_key: str, tmdb_id: int) -> str:
+    cache_key = f'movie:{tmdb_id}'
+    if poster_url := get_cached_poster(cache_key):
+        return poster_url
+    poster_url = fetch_poster(
+        f'https://api.themoviedb.org/3/movie/{tmdb_id}/images',
+        extract_tmdb_poster,
+        params={'api_key': api_key, 'include_image_language': 'en,null'},
+    )
+    if not poster_url:
+        logger.warning('No Poster Available on TMDB. Skipping...')
+        return DEFAULT_POSTER_URL
+    return set_cached_poster(cache_key, poster_url)
+
+
+@functools.lru_cache(maxsize=256)
+def get_album_cover(release_id: str, release_group_id: str | None = None) -> str:
+    cache_key = f'album:{release_id}'
+    if poster_url := get_cached_poster(cache_key):
+        return poster_url
+    futures = [
+        POOL.submit(
+            fetch_poster, f'https://coverartarchive.org/release/{release_id}', extract_album_cover
+        )
+    ]
+    if release_group_id:
+        futures.append(
+            POOL.submit(
+                fetch_poster,
+                f'https://coverartarchive.org/release-group/{release_group_id}',
+                extract_album_cover,
+            )
         )
-    except KeyError:
+    for future in futures:
+        if poster_url := future.result():
+            futures[-1].cancel()
+            return set_cached_poster(cache_key, poster_url)
+    logger.warning('No Album Cover Available on MusicBrainz. Skipping...')
+    return DEFAULT_POSTER_URL
+
+
+def get_start_time(session: dict) -> int:
+    position = session.get('PlayState', {}).get('PositionTicks', 0) // 10_000_000
+    try:
+        checked_in = datetime.fromisoformat(session['LastPlaybackCheckIn']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        checked_in = 0.0
+    if checked_in <= 0:
+        checked_in = time.time()
+    return int(checked_in) - position
+
+
+def format_episode(item: dict) -> tuple[str, str]:
+    season = item['ParentIndexNumber']
+    episode = item['IndexNumber']
+    state = item.get('SeriesName', '')
+    details = f'S{season}:E{episode} - {item["Name"]}'
+    return state, details
+
+
+def format_movie(item: dict) -> tuple[str, str]:
+    state = ', '.join(item.get('Genres', ()))
+    details = item['Name']
+    return state, details
+
+
+def format_audio(item: dict) -> tuple[str, str]:
+    artists = ', '.join(item.get('Artists', ()))
+    state = ' - '.join(filter(None, (artists, item.get('Album'))))
+    details = item['Name']
+    return state, details
+
+
+def get_imdb_id(item: dict) -> str:
+    for external_url in item.get('ExternalUrls', ()):
+        if external_url['Name'] == 'IMDb':
+            return external_url['Url'].rsplit('/', 1)[-1]
+    return ''
+
+
+def find_episode_poster(settings: Settings, jellyfin_api: api.API, item: dict) -> str:
+    if not settings.tmdb_api_key:
+        return DEFAULT_POSTER_URL
+    series_tmdb_id = None
+    if 'SeriesId' in item:
+        try:
+            series_tmdb_id = get_series_tmdb_id(
+                settings.jellyfin_host, jellyfin_api, item['SeriesId']
+            )
+        except (HTTPException, RequestException):
+            logger.warning('Connection Failed: Jellyfin. Skipping...')
+    imdb_id = get_imdb_id(item)
+    try:
+        if series_tmdb_id is not None:
+            return _get_season_poster(
+                settings.tmdb_api_key, series_tmdb_id, item['ParentIndexNumber']
+            )
+        if imdb_id:
+            return get_series_poster(settings.tmdb_api_key, imdb_id, item['ParentIndexNumber'])
+    except RequestException:
         logger.warning('Connection Failed: TMDB. Skipping...')
         return DEFAULT_POSTER_URL
+    logger.warning('No IMDb ID Found. Skipping...')
+    return DEFAULT_POSTER_URL
 
 
-def get_album_cover(musicbrainz_id: str) -> str:
-    response = requests.get(f'https://coverartarchive.org/release/{musicbrainz_id}')
+def find_movie_poster(settings: Settings, jellyfin_api: api.API, item: dict) -> str:
+    if not settings.tmdb_api_key:
+        return DEFAULT_POSTER_URL
+    tmdb_id = item.get('ProviderIds', {}).get('Tmdb', '')
+    imdb_id = get_imdb_id(item)
     try:
-        return json.loads(response.text)['images'][0]['image']
-    except KeyError:
+        if tmdb_id.isdigit():
+            return _get_movie_poster(settings.tmdb_api_key, int(tmdb_id))
+        if not imdb_id:
+            logger.warning('No IMDb ID Found. Skipping...')
+            return DEFAULT_POSTER_URL
+        return get_movie_poster(settings.tmdb_api_key, imdb_id)
+    except RequestException:
+        logger.warning('Connection Failed: TMDB. Skipping...')
+        return DEFAULT_POSTER_URL
+
+
+def find_album_cover(settings: Settings, jellyfin_api: api.API, item: dict) -> str:
+    try:
+        musicbrainz_ids = get_album_musicbrainz_ids(
+            settings.jellyfin_host, jellyfin_api, item.get('AlbumId')
+        )
+    except (HTTPException, RequestException):
+        logger.warning('Connection Failed: Jellyfin. Skipping...')
+        return DEFAULT_POSTER_URL
+    if musicbrainz_ids is None:
+        logger.warning('No MusicBrainz ID Found. Skipping...')
+        return DEFAULT_POSTER_URL
+    try:
+        return get_album_cover(*musicbrainz_ids)
+    except RequestException:
         logger.warning('Connection Failed: MusicBrainz. Skipping...')
         return DEFAULT_POSTER_URL
 
 
-def await_connection(discord_rpc: Presence, refresh_rate: int):
-    while True:
+MEDIA_HANDLERS: dict[
+    str,
+    tuple[Callable[[dict], tuple[str, str]], Callable[[Settings, api.API, dict], str], str],
+] = {
+    'Episode': (format_episode, find_episode_poster, 'Shows'),
+    'Movie': (format_movie, find_movie_poster, 'Movies'),
+    'Audio': (format_audio, find_album_cover, 'Music'),
+}
+
+
+def await_connection(discord_rpc: Presence, closed: threading.Event):
+    for attempt in itertools.count():
         try:
             discord_rpc.connect()
             logger.debug('Connection Established: Discord.')
         except DiscordNotFound:
-            logger.error('Connection Failed: Discord. Retrying...')
-            time.sleep(refresh_rate)
+            if attempt % 10 == 0:
+                logger.error('Connection Failed: Discord. Retrying...')
+            if closed.wait(get_retry_delay(attempt)):
+                return
             continue
         break
 
 
-def set_discord_rpc(config: SectionProxy, *, refresh_rate: int = 10):
+def warm_connection(url: str):
+    TimeoutHTTPAdapter.no_retry.active = True
+    try:
+        SESSION.head(url, timeout=(1, 1))
+    except RequestException:
+        pass
+    finally:
+        TimeoutHTTPAdapter.no_retry.active = False
+
+
+def warm_connections(settings: Settings):
+    if settings.tmdb_api_key and settings.media_types & {'Movies', 'Shows'}:
+        POOL.submit(warm_connection, 'https://api.themoviedb.org/3/')
+    if 'Music' in settings.media_types:
+        POOL.submit(warm_connection, 'https://coverartarchive.org/')
+
+
+def close_discord_rpc(discord_rpc: Presence):
+    if discord_rpc.sock_writer is None:
+        return
+    try:
+        discord_rpc.close()
+    except (PipeClosed, OSError):
+        pass
+
+
+def set_discord_rpc(
+    settings: Settings, *, refresh_rate: int = 10, listener: SessionListener | None = None
+):
+    if listener is None:
+        listener = SessionListener()
+    jellyfin_future = POOL.submit(get_jellyfin_api, settings, listener)
     discord_rpc = Presence(CLIENT_ID)
-    await_connection(discord_rpc, refresh_rate)
-    jellyfin_api = get_jellyfin_api(config, refresh_rate)
-    previous_details = ''
-    while True:
+    await_connection(discord_rpc, listener.closed)
+    jellyfin_api = jellyfin_future.result()
+    if jellyfin_api is None:
+        close_discord_rpc(discord_rpc)
+        return
+    user_id = jellyfin_api.config.data['auth.user_id']
+    previous_activity: tuple[str, str] | None = None
+    previous_item_id: str | None = None
+    previous_start = 0
+    idle_polls = 0
+    failed_polls = 0
+    while not listener.closed.is_set():
+        poll_interval = max(min(refresh_rate * 2**idle_polls, MAX_IDLE_INTERVAL), refresh_rate)
+        next_poll = time.monotonic() + poll_interval
         try:
-            session = next(
-                session
-                for session in jellyfin_api.sessions()
-                if config['USERNAME'] == session['UserName']
-            )
-        except StopIteration:
-            session = None
-        except HTTPException:
-            jellyfin_api = get_jellyfin_api(config, refresh_rate)
+            sessions = listener.sessions
+            if sessions is None:
+                listener.reconnect()
+                sessions = jellyfin_api.sessions(params={'activeWithinSeconds': 960}) or []
+        except (HTTPException, RequestException) as error:
+            failed_polls += 1
+            if failed_polls < MAX_FAILED_POLLS and getattr(error, 'status', None) != 'Unauthorized':
+                logger.warning('Connection Failed: Jellyfin. Retrying...')
+                listener.wait(next_poll)
+                continue
+            failed_polls = 0
+            jellyfin_api = get_jellyfin_api(settings, listener)
+            if jellyfin_api is None:
+                break
             continue
-        if session is not None and 'NowPlayingItem' in session:
-            media_types = config['MEDIA_TYPES'].split(',')
-            match media_type := session['NowPlayingItem']['Type']:
-                case 'Episode':
-                    if 'Shows' not in media_types:
-                        time.sleep(refresh_rate)
-                        continue
-                    season = session['NowPlayingItem']['ParentIndexNumber']
-                    episode = session['NowPlayingItem']['IndexNumber']
-                    state = ''
-                    if 'SeriesName' in session['NowPlayingItem']:
-                        state += session['NowPlayingItem']['SeriesName']
-                    details = f'{f"S{season}:E{episode}"} - {session["NowPlayingItem"]["Name"]}'
-                case 'Movie':
-                    if 'Movies' not in media_types:
-                        time.sleep(refresh_rate)
-                        continue
-                    state = ''
-                    if 'Genres' in session['NowPlayingItem']:
-                        state += ', '.join(session['NowPlayingItem']['Genres'])
-                    details = session['NowPlayingItem']['Name']
-                case 'Audio':
-                    if 'Music' not in media_types:
-                        time.sleep(refresh_rate)
-                        continue
-                    state = ''
-                    if 'Artists' in session['NowPlayingItem']:
-                        state += ', '.join(session['NowPlayingItem']['Artists'])
-                    if 'Album' in session['NowPlayingItem']:
-                        state += ' - ' + session['NowPlayingItem']['Album']
-                    details = session['NowPlayingItem']['Name']
-                case _:
-                    logger.warning(f'Unsupported Media Type: {media_type}. Ignoring...')
-                    time.sleep(refresh_rate)
-                    continue  # raise NotImplementedError()
-            if details != previous_details:
-                poster_url = DEFAULT_POSTER_URL
-                if media_type in ('Episode', 'Movie') and len(config['TMDB_API_KEY']) > 0:
-                    try:
-                        imdb_id = next(
-                            external_url['Url']
-                            for external_url in session['NowPlayingItem']['ExternalUrls']
-                            if external_url['Name'] == 'IMDb'
-                        ).split('/')[-1]
-                    except StopIteration:
-                        logger.warning('No IMDb ID Found. Skipping...')
-                    else:
-                        try:
-                            if session['NowPlayingItem']['Type'] == 'Episode':
-                                poster_url = get_series_poster(
-                                    config['TMDB_API_KEY'], imdb_id, season
-                                )
-                            elif session['NowPlayingItem']['Type'] == 'Movie':
-                                poster_url = get_movie_poster(config['TMDB_API_KEY'], imdb_id)
-                        except RequestException:
-                            logger.warning('Connection Failed: TMDB. Skipping...')
-                elif media_type == 'Audio':
-                    try:
-                        album = jellyfin_api.get_item(session['NowPlayingItem']['AlbumId'])
-                        musicbrainz_id = album['ProviderIds']['MusicBrainzAlbum']
-                    except KeyError:
-                        logger.warning('No MusicBrainz ID Found. Skipping...')
-                    try:
-                        poster_url = get_album_cover(musicbrainz_id)
-                    except RequestException:
-                        logger.warning('Connection Failed: MusicBrainz. Skipping...')
+        failed_polls = 0
+        session = None
+        for user_session in sessions:
+            if user_session.get('UserId') == user_id and 'NowPlayingItem' in user_session:
+                session = user_session
+                break
+        idle_polls = 0 if session is not None else min(idle_polls + 1, 6)
+        if session is not None:
+            item = session['NowPlayingItem']
+            play_state = session.get('PlayState', {})
+            start = get_start_time(session)
+            drifted = (
+                not play_state.get('IsPaused') and abs(start - previous_start) > MAX_START_DRIFT
+            )
+            if item['Id'] == previous_item_id and not drifted:
+                listener.wait(next_poll)
+                continue
+            previous_item_id = item['Id']
+            previous_start = start
+            media_type = item['Type']
+            if media_type not in MEDIA_HANDLERS:
+                logger.warning('Unsupported Media Type: %s. Ignoring...', media_type)
+                listener.wait(next_poll)
+                continue  # raise NotImplementedError()
+            formatter, find_poster, media_category = MEDIA_HANDLERS[media_type]
+            if media_category not in settings.media_types:
+                listener.wait(next_poll)
+                continue
+            state, details = formatter(item)
+            activity = (state, details)
+            if activity != previous_activity or drifted:
+                poster_url = find_poster(settings, jellyfin_api, item)
                 try:
-                    # source_id = session['NowPlayingItem']['Id']
-                    # server_id = session['NowPlayingItem']['ServerId']
+                    # source_id = item['Id']
+                    # server_id = item['ServerId']
                     # url_path = f'web/#/details?id={source_id}&serverId={server_id}'
                     if len(details) < 2:  # e.g., Chinese characters
                         details += ' '
                     discord_rpc.update(
                         state=state,
                         details=details,
-                        start=time.time(),
+                        start=start,
                         large_image=poster_url,
                         # buttons=[
-                        #     {'label': 'Play on Jellyfin', 'url': config['JELLYFIN_HOST'] + url_path}
+                        #     {'label': 'Play on Jellyfin', 'url': settings.jellyfin_host + url_path}
                         # ],
                     )
-                    logger.info(f'RPC Updated: {details}.')
+                    logger.info('RPC Updated: %s.', details)
                 except PipeClosed:
-                    await_connection(discord_rpc, refresh_rate)
+                    await_connection(discord_rpc, listener.closed)
+                    previous_activity = None
+                    previous_item_id = None
                     continue
-                previous_details = details
-        elif previous_details:
+                previous_activity = activity
+        elif previous_activity is not None:
             try:
                 discord_rpc.clear()
             except PipeClosed:
-                await_connection(discord_rpc, refresh_rate)
+                await_connection(discord_rpc, listener.closed)
                 continue
-            logger.info(f'RPC Cleared: {previous_details}.')
-            previous_details = ''
-        time.sleep(refresh_rate)
+            logger.info('RPC Cleared: %s.', previous_activity[1])
+            previous_activity = None
+            previous_item_id = None
+        listener.wait(next_poll)
+    close_discord_rpc(discord_rpc)
 
 
-def main():
+def stop_logging():
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+
+def main(listener: SessionListener | None = None):
+    global log_listener
     parser = argparse.ArgumentParser()
     parser.add_argument('--ini-path', default='jellyfin_rpc.ini')
     parser.add_argument('--log-path', default='jellyfin_rpc.log')
+    parser.add_argument('--cache-path', default='jellyfin_rpc.json')
     parser.add_argument('--refresh-rate', type=int, default=10)
     args = parser.parse_args()
 
     config = get_config(args.ini_path)
+    set_device_id(config, args.ini_path)
     logger.setLevel(config['LOG_LEVEL'])
-    file_hdlr = logging.FileHandler(args.log_path, encoding='utf-8')
-    file_hdlr.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
-    logger.addHandler(file_hdlr)
-    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if not logger.handlers:
+        file_hdlr = logging.FileHandler(args.log_path, encoding='utf-8')
+        file_hdlr.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        log_listener = logging.handlers.QueueListener(
+            log_queue, file_hdlr, logging.StreamHandler(sys.stdout)
+        )
+        log_listener.start()
+        atexit.register(stop_logging)
+    load_cache(args.cache_path)
 
-    set_discord_rpc(config, refresh_rate=args.refresh_rate)
+    settings = get_settings(config)
+    warm_connections(settings)
+    own_listener = SessionListener() if listener is None else None
+    try:
+        set_discord_rpc(settings, refresh_rate=args.refresh_rate, listener=listener or own_listener)
+    finally:
+        if own_listener is not None:
+            own_listener.close()
+            POOL.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == '__main__':
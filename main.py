@@ -1,122 +1,200 @@
-import configparser
+from __future__ import annotations
+
 import functools
-import multiprocessing
 import os
 import shutil
 import sys
+import threading
+import time
 import webbrowser
-from typing import Callable
+from typing import TYPE_CHECKING, Callable
 
-import customtkinter
-import pystray
-import requests
-from PIL import Image
+from requests.exceptions import RequestException
 
 import jellyfin_rpc
 
+if TYPE_CHECKING:
+    import customtkinter
+    import pystray
+
 __version__ = '1.3.0'
 
+RELEASE_URL = 'https://api.github.com/repos/kennethsible/jellyfin-rpc/releases/latest'
+RELEASE_HEADERS = {
+    'Accept': 'application/vnd.github+json',
+    'User-Agent': f'jellyfin-rpc/{__version__}',
+}
+RELEASE_CHECK_TTL = 24 * 60 * 60
+TOGGLE_DEBOUNCE = 0.5
+
+ENTRY_FIELDS = (
+    ('JELLYFIN_HOST', 'Jellyfin Host'),
+    ('API_TOKEN', 'API Token'),
+    ('USERNAME', 'Username'),
+    ('TMDB_API_KEY', 'TMDB API Key (Optional)'),
+)
 
-class RPCProcess:
+MEDIA_TYPES = ('Movies', 'Shows', 'Music')
 
-    def __init__(self, target: Callable):
+
+class RPCThread:
+
+    def __init__(self, target: Callable[[jellyfin_rpc.SessionListener], None]):
         self.target = target
-        self.process: multiprocessing.Process | None = None
+        self.listener: jellyfin_rpc.SessionListener | None = None
+        self.on_exit: Callable[[jellyfin_rpc.SessionListener], None] | None = None
 
     def start(self):
-        self.process = multiprocessing.Process(target=self.target)
-        self.process.start()
+        self.listener = jellyfin_rpc.SessionListener()
+        threading.Thread(target=self.run, args=(self.listener,), daemon=True).start()
+
+    def run(self, listener: jellyfin_rpc.SessionListener):
+        try:
+            self.target(listener)
+        finally:
+            if not listener.closed.is_set() and self.on_exit is not None:
+                self.on_exit(listener)
+
+    def is_running(self) -> bool:
+        return self.listener is not None
 
     def stop(self):
-        if self.process is None:
+        if self.listener is None:
             return
-        if self.process.is_alive():
-            self.process.terminate()
-            self.process.join()
-
-
-def on_click(
-    rpc_process: RPCProcess,
-    ini_path: str,
-    entry1: customtkinter.CTkEntry,
-    entry2: customtkinter.CTkEntry,
-    entry3: customtkinter.CTkEntry,
-    entry4: customtkinter.CTkEntry,
-    checkbox1: customtkinter.CTkCheckBox,
-    checkbox2: customtkinter.CTkCheckBox,
-    checkbox3: customtkinter.CTkCheckBox,
-    button1: customtkinter.CTkButton,
-):
-    if button1._text == 'Connect':
-        config = configparser.ConfigParser()
-        config.read(ini_path)
-        config.set('DEFAULT', 'JELLYFIN_HOST', entry1.get())
-        config.set('DEFAULT', 'API_TOKEN', entry2.get())
-        config.set('DEFAULT', 'USERNAME', entry3.get())
-        config.set('DEFAULT', 'TMDB_API_KEY', entry4.get())
-        media_types = []
-        if checkbox1._variable.get():
-            media_types.append('Movies')
-        if checkbox2._variable.get():
-            media_types.append('Shows')
-        if checkbox3._variable.get():
-            media_types.append('Music')
-        config.set('DEFAULT', 'MEDIA_TYPES', ','.join(media_types))
-        with open(ini_path, 'w') as ini_file:
-            config.write(ini_file)
-        rpc_process.start()
-        for entry in (entry1, entry2, entry3, entry4, checkbox1, checkbox2, checkbox3):
-            entry.configure(state='readonly')
-            entry.update()
-        button1.configure(text='Disconnect')
-    else:
-        rpc_process.stop()
-        for entry in (entry1, entry2, entry3, entry4, checkbox1, checkbox2, checkbox3):
-            entry.configure(state='normal')
-            entry.update()
-        button1.configure(text='Connect')
-    button1.update()
+        self.listener.close()
+        self.listener = None
+
+
+class RPCForm:
+
+    def __init__(
+        self,
+        rpc_thread: RPCThread,
+        ini_path: str,
+        entries: list[customtkinter.CTkEntry],
+        checkboxes: list[customtkinter.CTkCheckBox],
+        button: customtkinter.CTkButton,
+    ):
+        self.rpc_thread = rpc_thread
+        self.ini_path = ini_path
+        self.entries = entries
+        self.checkboxes = checkboxes
+        self.button = button
+        self.last_toggle = 0.0
+
+    def connect(self):
+        config = jellyfin_rpc.get_config(self.ini_path)
+        values = {key: entry.get() for (key, _), entry in zip(ENTRY_FIELDS, self.entries)}
+        values['MEDIA_TYPES'] = ','.join(
+            media_type
+            for media_type, checkbox in zip(MEDIA_TYPES, self.checkboxes)
+            if checkbox.get()
+        )
+        if any(config.get(key) != value for key, value in values.items()):
+            config.update(values)
+            jellyfin_rpc.set_config(config, self.ini_path)
+        self.rpc_thread.start()
+        for widget in (*self.entries, *self.checkboxes):
+            widget.configure(state='readonly')
+        self.button.configure(text='Disconnect')
+
+    def disconnect(self):
+        self.rpc_thread.stop()
+        for widget in (*self.entries, *self.checkboxes):
+            widget.configure(state='normal')
+        self.button.configure(text='Connect')
+
+    def toggle(self):
+        now = time.monotonic()
+        if now - self.last_toggle < TOGGLE_DEBOUNCE:
+            return
+        self.last_toggle = now
+        if not self.rpc_thread.is_running():
+            self.connect()
+        else:
+            self.disconnect()
 
 
-def on_maximize(root: customtkinter.CTk, label: customtkinter.CTkLabel):
-    response = requests.get(
-        'https://api.github.com/repos/kennethsible/jellyfin-rpc/releases/latest'
-    )
-    latest_ver = response.json()['tag_name'].lstrip('v')
+def get_latest_version(ini_path: str) -> str:
+    config = jellyfin_rpc.get_config(ini_path)
+    latest_ver = config.get('LATEST_VERSION', '')
+    checked_at = float(config.get('LAST_VERSION_CHECK', '') or 0)
+    if latest_ver and time.time() - checked_at < RELEASE_CHECK_TTL:
+        return latest_ver
+    etag = config.get('LATEST_VERSION_ETAG', '') if latest_ver else ''
+    headers = {**RELEASE_HEADERS, 'If-None-Match': etag} if etag else RELEASE_HEADERS
+    response = jellyfin_rpc.SESSION.get(RELEASE_URL, headers=headers)
+    if response.status_code != 304:
+        release = jellyfin_rpc.json_loads(response.content)
+        latest_ver = release['tag_name'].lstrip('v')
+        config['LATEST_VERSION_ETAG'] = response.headers.get('ETag', '')
+    config['LATEST_VERSION'] = latest_ver
+    config['LAST_VERSION_CHECK'] = str(int(time.time()))
+    jellyfin_rpc.set_config(config, ini_path)
+    return latest_ver
+
+
+def on_maximize(root: customtkinter.CTk, label: customtkinter.CTkLabel, ini_path: str):
+    root.after(0, root.deiconify)
+    try:
+        latest_ver = get_latest_version(ini_path)
+    except (RequestException, KeyError, ValueError):
+        return
     if latest_ver == __version__:
-        label.configure(
-            text_color='gray',
-            text=f'Current Version ({__version__})',
-        )
+        text_color, text = 'gray', f'Current Version ({__version__})'
     else:
-        label.configure(
-            text_color='red',
-            text=f'Update Available ({__version__} \u2192 {latest_ver})',
-        )
-    root.after(0, root.deiconify)
+        text_color, text = 'red', f'Update Available ({__version__} \u2192 {latest_ver})'
+    root.after(0, functools.partial(set_version_label, label, text_color, text))
+
+
+def set_version_label(label: customtkinter.CTkLabel, text_color: str, text: str):
+    if label.cget('text') != text:
+        label.configure(text_color=text_color, text=text)
+
+
+def on_rpc_exit(form: RPCForm, listener: jellyfin_rpc.SessionListener):
+    if form.rpc_thread.listener is listener:
+        form.disconnect()
 
 
 def on_close(
-    rpc_process: RPCProcess,
+    rpc_thread: RPCThread,
     icon: pystray._base.Icon,
     root: customtkinter.CTk,
 ):
-    rpc_process.stop()
+    rpc_thread.stop()
+    jellyfin_rpc.stop_logging()
     icon.visible = False
     icon.stop()
     root.quit()
 
 
+def create_entry(
+    master: customtkinter.CTkFrame, value: str, placeholder_text: str
+) -> customtkinter.CTkEntry:
+    import customtkinter
+
+    if value:
+        entry_text = customtkinter.StringVar(value=value)
+        return customtkinter.CTkEntry(master=master, textvariable=entry_text, width=265)
+    return customtkinter.CTkEntry(master=master, placeholder_text=placeholder_text, width=265)
+
+
 def callback(url: str):
     webbrowser.open_new_tab(url)
 
 
 def main():
+    import customtkinter
+    import pystray
+    from PIL import Image
+
     customtkinter.set_appearance_mode('system')
     customtkinter.set_default_color_theme('dark-blue')
 
     root = customtkinter.CTk()
     root.title('Jellyfin RPC')
+    root.withdraw()
 
     frame = customtkinter.CTkFrame(master=root)
     frame.pack(fill='both', expand=True)
@@ -129,6 +207,7 @@ def main():
         shutil.copyfile(ini_path, 'jellyfin_rpc.ini')
     ini_path = 'jellyfin_rpc.ini'
     config = jellyfin_rpc.get_config(ini_path)
+    values = {key: config.get(key, '') for key, _ in ENTRY_FIELDS}
 
     label1 = customtkinter.CTkLabel(master=frame, cursor='hand2')
     label1.bind(
@@ -136,123 +215,40 @@ def main():
     )
     label1.pack(pady=0, padx=10)
 
-    if config['JELLYFIN_HOST']:
-        entry1_text = customtkinter.StringVar()
-        entry1 = customtkinter.CTkEntry(
-            master=frame,
-            textvariable=entry1_text,
-            width=265,
-        )
-        entry1_text.set(config['JELLYFIN_HOST'])
-    else:
-        entry1 = customtkinter.CTkEntry(
-            master=frame,
-            placeholder_text='Jellyfin Host',
-            width=265,
-        )
-    entry1.pack(pady=(0, 5), padx=10)
-
-    if config['API_TOKEN']:
-        entry2_text = customtkinter.StringVar()
-        entry2 = customtkinter.CTkEntry(
-            master=frame,
-            textvariable=entry2_text,
-            width=265,
-        )
-        entry2_text.set(config['API_TOKEN'])
-    else:
-        entry2 = customtkinter.CTkEntry(
-            master=frame,
-            placeholder_text='API Token',
-            width=265,
-        )
-    entry2.pack(pady=5, padx=10)
-
-    if config['USERNAME']:
-        entry3_text = customtkinter.StringVar()
-        entry3 = customtkinter.CTkEntry(
-            master=frame,
-            textvariable=entry3_text,
-            width=265,
-        )
-        entry3_text.set(config['USERNAME'])
-    else:
-        entry3 = customtkinter.CTkEntry(
-            master=frame,
-            placeholder_text='Username',
-            width=265,
-        )
-    entry3.pack(pady=5, padx=10)
-
-    if config['TMDB_API_KEY']:
-        entry4_text = customtkinter.StringVar()
-        entry4 = customtkinter.CTkEntry(
-            master=frame,
-            textvariable=entry4_text,
-            width=265,
-        )
-        entry4_text.set(config['TMDB_API_KEY'])
-    else:
-        entry4 = customtkinter.CTkEntry(
-            master=frame,
-            placeholder_text='TMDB API Key (Optional)',
-            width=265,
-        )
-    entry4.pack(pady=5, padx=10)
-
-    media_types = config['MEDIA_TYPES'].split(',')
-    checkbox1_var = customtkinter.IntVar(value=int('Movies' in media_types))
-    checkbox1 = customtkinter.CTkCheckBox(master=frame, text='Movies', variable=checkbox1_var)
-    checkbox1.pack(pady=5, padx=10)
-
-    checkbox2_var = customtkinter.IntVar(value=int('Shows' in media_types))
-    checkbox2 = customtkinter.CTkCheckBox(master=frame, text='Shows', variable=checkbox2_var)
-    checkbox2.pack(pady=5, padx=10)
-
-    checkbox3_var = customtkinter.IntVar(value=int('Music' in media_types))
-    checkbox3 = customtkinter.CTkCheckBox(master=frame, text='Music', variable=checkbox3_var)
-    checkbox3.pack(pady=5, padx=10)
-
-    rpc_process = RPCProcess(functools.partial(jellyfin_rpc.main))
-    button1 = customtkinter.CTkButton(
-        master=frame,
-        text='Connect',
-        command=lambda: on_click(
-            rpc_process,
-            ini_path,
-            entry1,
-            entry2,
-            entry3,
-            entry4,
-            checkbox1,
-            checkbox2,
-            checkbox3,
-            button1,
-        ),
-    )
+    entries = []
+    for key, placeholder_text in ENTRY_FIELDS:
+        entry = create_entry(frame, values[key], placeholder_text)
+        entry.pack(pady=5 if entries else (0, 5), padx=10)
+        entries.append(entry)
+
+    media_types = {media_type.strip() for media_type in config.get('MEDIA_TYPES', '').split(',')}
+    checkboxes = []
+    for media_type in MEDIA_TYPES:
+        checkbox_var = customtkinter.IntVar(value=int(media_type in media_types))
+        checkbox = customtkinter.CTkCheckBox(master=frame, text=media_type, variable=checkbox_var)
+        checkbox.pack(pady=5, padx=10)
+        checkboxes.append(checkbox)
+
+    rpc_thread = RPCThread(jellyfin_rpc.main)
+    button1 = customtkinter.CTkButton(master=frame, text='Connect')
     button1.pack(pady=(5, 10), padx=10)
-    if config['JELLYFIN_HOST'] and config['API_TOKEN'] and config['USERNAME']:
-        on_click(
-            rpc_process,
-            ini_path,
-            entry1,
-            entry2,
-            entry3,
-            entry4,
-            checkbox1,
-            checkbox2,
-            checkbox3,
-            button1,
-        )
+    form = RPCForm(rpc_thread, ini_path, entries, checkboxes, button1)
+    button1.configure(command=form.toggle)
+    rpc_thread.on_exit = lambda listener: root.after(
+        0, functools.partial(on_rpc_exit, form, listener)
+    )
+    if values['JELLYFIN_HOST'] and values['API_TOKEN'] and values['USERNAME']:
+        form.connect()
 
-    root.withdraw()
+    with Image.open(png_path, formats=['PNG']) as icon_image:
+        icon_image.load()
     icon = pystray.Icon(
         'jellyfin-rpc',
-        Image.open(png_path),
+        icon_image,
         'Jellyfin RPC',
         menu=pystray.Menu(
-            pystray.MenuItem('Maximize', lambda: on_maximize(root, label1), default=True),
-            pystray.MenuItem('Quit', lambda: on_close(rpc_process, icon, root)),
+            pystray.MenuItem('Maximize', lambda: on_maximize(root, label1, ini_path), default=True),
+            pystray.MenuItem('Quit', lambda: on_close(rpc_thread, icon, root)),
         ),
     )
     icon.run_detached()
@@ -264,5 +260,4 @@ def main():
 
 
 if __name__ == '__main__':
-    multiprocessing.freeze_support()
     main()